@@ -0,0 +1,75 @@
+import tempfile
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from llama_zip import LlamaZip
+
+# Build a tiny random Llama model with a byte-level BPE tokenizer, so the
+# round trip can be checked on CPU without downloading anything
+CORPUS = [
+    "The quick brown fox jumps over the lazy dog.",
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit.",
+    "Ünïcödé tëxt, 日本語, and emoji 🦙 all round trip.",
+]
+
+tokenizer = Tokenizer(models.BPE())
+tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+tokenizer.decoder = decoders.ByteLevel()
+tokenizer.train_from_iterator(
+    CORPUS,
+    trainers.BpeTrainer(
+        vocab_size=400,
+        special_tokens=["<s>", "</s>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    ),
+)
+tokenizer = PreTrainedTokenizerFast(
+    tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>"
+)
+
+torch.manual_seed(0)
+model = LlamaForCausalLM(
+    LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        max_position_embeddings=256,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+)
+
+with tempfile.TemporaryDirectory() as model_path:
+    tokenizer.save_pretrained(model_path)
+    model.save_pretrained(model_path)
+
+    # A small context length forces the context window to slide. The model
+    # runs on a CUDA GPU when one is available, and on the CPU otherwise
+    compressor = LlamaZip(model_path=model_path, n_ctx=16)
+
+inputs = [
+    b"The quick brown fox jumps over the lazy dog. " * 4,
+    b"\xff\xfe invalid UTF-8 \x80\xc3 and a PUA char \xee\x80\x81 " * 2,
+    "Ünïcödé tëxt, 日本語, and emoji 🦙".encode("utf-8"),
+    b"",
+]
+
+for window_overlap in (0, 5, 15):
+    for original in inputs:
+        compressed = compressor.compress(original, window_overlap)
+        # Decompress twice to check that repeated calls are independent
+        for _ in range(2):
+            decompressed = compressor.decompress(compressed, window_overlap)
+            assert decompressed == original, (window_overlap, original, decompressed)
+
+    # Streams of different lengths compressed together in one batch
+    batch = [inputs[0], inputs[1][:7]]
+    compressed_list = compressor.compress_batch(batch, window_overlap)
+    decompressed_list = compressor.decompress_batch(compressed_list, window_overlap)
+    assert decompressed_list == batch, (window_overlap, decompressed_list)
+
+print("ok")
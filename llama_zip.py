@@ -4,50 +4,78 @@ import codecs
 import signal
 import sys
 
-import numpy as np
 import torch
 from more_itertools import consume
 from tqdm import tqdm
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    BitsAndBytesConfig,
+    StaticCache,
+)
 
 PUA_START = 0xE000
 
 NUM_STATE_BITS = 64
 FREQ_SCALE_FACTOR = 1 << 32
+MAX_STATIC_CACHE_LENGTH = 4096
+
+# Characters to escape after decoding with surrogateescape: invalid bytes
+# (U+DC80..U+DCFF) and characters already in the PUA range
+UTF8_ESCAPES = {0xDC00 + byte: PUA_START + byte for byte in range(0x80, 0x100)}
+UTF8_ESCAPES.update(
+    (char, "".join(chr(PUA_START + byte) for byte in chr(char).encode("utf-8")))
+    for char in range(PUA_START, PUA_START + 0x100)
+)
+# Maps each escaped byte back to a character that encodes to that byte
+# (bytes >= 0x80 go through surrogateescape)
+UTF8_UNESCAPES = {
+    PUA_START + byte: byte if byte < 0x80 else 0xDC00 + byte for byte in range(0x100)
+}
 
 BASE64 = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
 BASE64_EQ = BASE64 + b"="
+NON_BASE64 = bytes(byte for byte in range(0x100) if byte not in BASE64)
 
 
 class ArithmeticCoderBase:
     def __init__(self):
         full_range = 1 << NUM_STATE_BITS
         self.half_range = full_range >> 1
-        self.quarter_range = self.half_range >> 1
         self.state_mask = full_range - 1
         self.low = 0
         self.high = self.state_mask
 
-    def update(self, cum_freqs, symbol):
-        total = int(cum_freqs[-1])
+    def update(self, symlow, symhigh, total):
         range = self.high - self.low + 1
-        symhigh = int(cum_freqs[symbol])
         self.high = self.low + symhigh * range // total - 1
-        symlow = int(cum_freqs[symbol - 1]) if symbol > 0 else 0
         self.low = self.low + symlow * range // total
-        while ((self.low ^ self.high) & self.half_range) == 0:
-            self.shift()
-            self.low = (self.low << 1) & self.state_mask
-            self.high = ((self.high << 1) & self.state_mask) | 1
-        while (self.low & ~self.high & self.quarter_range) != 0:
-            self.underflow()
-            self.low = (self.low << 1) ^ self.half_range
-            self.high = ((self.high ^ self.half_range) << 1) | self.half_range | 1
-
-    def shift(self):
+        # Shift out every leading bit that low and high share in one step
+        num_shift = NUM_STATE_BITS - (self.low ^ self.high).bit_length()
+        if num_shift > 0:
+            self.shift(num_shift)
+            self.low = (self.low << num_shift) & self.state_mask
+            self.high = ((self.high << num_shift) & self.state_mask) | (
+                (1 << num_shift) - 1
+            )
+        # Likewise for the run of underflow bits (low = 01..., high = 10...)
+        underflow_bits = self.low & ~self.high & (self.half_range - 1)
+        num_underflow = (NUM_STATE_BITS - 1) - (
+            ~underflow_bits & (self.half_range - 1)
+        ).bit_length()
+        if num_underflow > 0:
+            self.underflow(num_underflow)
+            self.low = (self.low << num_underflow) & (self.half_range - 1)
+            self.high = (
+                ((self.high << num_underflow) & (self.half_range - 1))
+                | self.half_range
+                | ((1 << num_underflow) - 1)
+            )
+
+    def shift(self, num_bits):
         raise NotImplementedError()
 
-    def underflow(self):
+    def underflow(self, num_bits):
         raise NotImplementedError()
 
 
@@ -55,34 +83,54 @@ class Encoder(ArithmeticCoderBase):
     def __init__(self):
         super().__init__()
         self.encoded_data = bytearray()
-        self.bit_index = 8
+        self.bit_buffer = 0
+        self.num_buffered_bits = 0
         self.num_underflow = 0
 
     def get_encoded(self):
         return self.encoded_data
 
     def encode_symbol(self, cum_freqs, symbol):
-        self.update(cum_freqs, symbol)
+        # Fetch the symbol's bounds and the total in a single transfer
+        if symbol > 0:
+            symlow, symhigh, total = cum_freqs[[symbol - 1, symbol, -1]].tolist()
+        else:
+            symlow = 0
+            symhigh, total = cum_freqs[[0, -1]].tolist()
+        self.update(symlow, symhigh, total)
 
     def finish(self):
-        self.append_bit(1)
-
-    def shift(self):
-        bit = self.low >> (NUM_STATE_BITS - 1)
-        self.append_bit(bit)
-        for _ in range(self.num_underflow):
-            self.append_bit(bit ^ 1)
+        self.write_bits(1, 1)
+        # Flush the final partial byte, padded with zeros
+        if self.num_buffered_bits > 0:
+            self.encoded_data.append(self.bit_buffer << (8 - self.num_buffered_bits))
+            self.bit_buffer = 0
+            self.num_buffered_bits = 0
+
+    def shift(self, num_bits):
+        bits = self.low >> (NUM_STATE_BITS - num_bits)
+        bit = bits >> (num_bits - 1)
+        # The first bit is followed by one opposite bit per pending underflow
+        underflow_bits = 0 if bit else (1 << self.num_underflow) - 1
+        self.write_bits(
+            (((bit << self.num_underflow) | underflow_bits) << (num_bits - 1))
+            | (bits & ((1 << (num_bits - 1)) - 1)),
+            num_bits + self.num_underflow,
+        )
         self.num_underflow = 0
 
-    def underflow(self):
-        self.num_underflow += 1
+    def underflow(self, num_bits):
+        self.num_underflow += num_bits
 
-    def append_bit(self, bit):
-        if self.bit_index == 8:
-            self.encoded_data.append(0)
-            self.bit_index = 0
-        self.encoded_data[-1] |= bit << (7 - self.bit_index)
-        self.bit_index += 1
+    def write_bits(self, bits, num_bits):
+        self.bit_buffer = (self.bit_buffer << num_bits) | bits
+        self.num_buffered_bits += num_bits
+        if self.num_buffered_bits >= 8:
+            num_bytes, self.num_buffered_bits = divmod(self.num_buffered_bits, 8)
+            self.encoded_data.extend(
+                (self.bit_buffer >> self.num_buffered_bits).to_bytes(num_bytes, "big")
+            )
+            self.bit_buffer &= (1 << self.num_buffered_bits) - 1
 
 
 class Decoder(ArithmeticCoderBase):
@@ -90,154 +138,75 @@ class Decoder(ArithmeticCoderBase):
         super().__init__()
         self.input = data
         self.byte_index = 0
-        self.bit_index = 0
-        self.code = sum(
-            self.read_code_bit() << i for i in range(NUM_STATE_BITS - 1, -1, -1)
-        )
+        self.bit_buffer = 0
+        self.num_buffered_bits = 0
+        self.code = self.read_code_bits(NUM_STATE_BITS)
 
     def decode_symbol(self, cum_freqs):
-        total = int(cum_freqs[-1])
+        total = cum_freqs[-1].item()
         range = self.high - self.low + 1
         offset = self.code - self.low
         value = ((offset + 1) * total - 1) // range
-        symbol = np.searchsorted(cum_freqs, value, side="right")
-        self.update(cum_freqs, symbol)
+        symbol = torch.searchsorted(
+            cum_freqs, torch.tensor([value], device=cum_freqs.device), right=True
+        )
+        # Fetch the symbol and its bounds in a single transfer
+        bounds = cum_freqs[torch.cat([symbol - 1, symbol]).clamp_(min=0)]
+        symbol, symlow, symhigh = torch.cat([symbol, bounds]).tolist()
+        if symbol == 0:
+            symlow = 0
+        self.update(symlow, symhigh, total)
         return symbol
 
-    def shift(self):
-        self.code = ((self.code << 1) & self.state_mask) | self.read_code_bit()
+    def shift(self, num_bits):
+        self.code = ((self.code << num_bits) & self.state_mask) | self.read_code_bits(
+            num_bits
+        )
 
-    def underflow(self):
+    def underflow(self, num_bits):
         self.code = (
             (self.code & self.half_range)
-            | ((self.code << 1) & (self.state_mask >> 1))
-            | self.read_code_bit()
+            | ((self.code << num_bits) & (self.half_range - 1))
+            | self.read_code_bits(num_bits)
         )
 
-    def read_code_bit(self):
-        if self.byte_index >= len(self.input):
-            return 0
-        bit = (self.input[self.byte_index] >> (7 - self.bit_index)) & 1
-        self.bit_index = (self.bit_index + 1) % 8
-        if self.bit_index == 0:
-            self.byte_index += 1
-        return bit
-
-
-# Based on Rust's std::str::Utf8Chunks
-class Utf8Chunks:
-    def __init__(self, source: bytes):
-        self.source = source
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        if not self.source:
-            raise StopIteration
-
-        TAG_CONT_U8 = 128
-
-        def safe_get(xs, i):
-            try:
-                return xs[i]
-            except IndexError:
-                return 0
-
-        i = 0
-        valid_up_to = 0
-        while i < len(self.source):
-            byte = self.source[i]
-            i += 1
-
-            if byte < 0x80:
-                # ASCII
-                pass
-            elif 0xC2 <= byte <= 0xDF:
-                # 2-byte sequence
-                if safe_get(self.source, i) & 192 != TAG_CONT_U8:
-                    break
-                i += 1
-            elif 0xE0 <= byte <= 0xEF:
-                # 3-byte sequence
-                next_byte = safe_get(self.source, i)
-                if 0xE0 == byte and 0xA0 <= next_byte <= 0xBF:
-                    pass
-                elif 0xE1 <= byte <= 0xEC and 0x80 <= next_byte <= 0xBF:
-                    pass
-                elif 0xED == byte and 0x80 <= next_byte <= 0x9F:
-                    pass
-                elif 0xEE <= byte <= 0xEF and 0x80 <= next_byte <= 0xBF:
-                    pass
-                else:
-                    break
-                i += 1
-                if safe_get(self.source, i) & 192 != TAG_CONT_U8:
-                    break
-                i += 1
-            elif 0xF0 <= byte <= 0xF4:
-                # 4-byte sequence
-                next_byte = safe_get(self.source, i)
-                if 0xF0 == byte and 0x90 <= next_byte <= 0xBF:
-                    pass
-                elif 0xF1 <= byte <= 0xF3 and 0x80 <= next_byte <= 0xBF:
-                    pass
-                elif 0xF4 == byte and 0x80 <= next_byte <= 0x8F:
-                    pass
-                else:
-                    break
-                i += 1
-                if safe_get(self.source, i) & 192 != TAG_CONT_U8:
-                    break
-                i += 1
-                if safe_get(self.source, i) & 192 != TAG_CONT_U8:
-                    break
-                i += 1
-            else:
-                break
-
-            valid_up_to = i
-
-        inspected, remaining = self.source[:i], self.source[i:]
-        self.source = remaining
-
-        valid, invalid = inspected[:valid_up_to], inspected[valid_up_to:]
-        return Utf8Chunk(valid, invalid)
-
-
-class Utf8Chunk:
-    def __init__(self, valid: bytes, invalid: bytes):
-        self.valid = valid
-        self.invalid = invalid
+    def read_code_bits(self, num_bits):
+        if self.num_buffered_bits < num_bits:
+            # Refill with whole bytes, reading zeros past the end of the input
+            num_bytes = (num_bits - self.num_buffered_bits + 7) // 8
+            chunk = self.input[self.byte_index : self.byte_index + num_bytes]
+            self.byte_index += num_bytes
+            self.bit_buffer = (self.bit_buffer << (8 * num_bytes)) | (
+                int.from_bytes(chunk, "big") << (8 * (num_bytes - len(chunk)))
+            )
+            self.num_buffered_bits += 8 * num_bytes
+        self.num_buffered_bits -= num_bits
+        bits = self.bit_buffer >> self.num_buffered_bits
+        self.bit_buffer &= (1 << self.num_buffered_bits) - 1
+        return bits
 
 
 def bytes_to_utf8(data: bytes):
-    output = bytearray()
-    for chunk in Utf8Chunks(data):
-        for char in chunk.valid.decode("utf-8"):
-            if PUA_START <= ord(char) <= PUA_START + 0xFF:
-                for byte in char.encode("utf-8"):
-                    output.extend(chr(PUA_START + byte).encode("utf-8"))
-            else:
-                output.extend(char.encode("utf-8"))
-        for byte in chunk.invalid:
-            output.extend(chr(PUA_START + byte).encode("utf-8"))
-    return bytes(output)
+    # ASCII is valid UTF-8 and contains no PUA characters, so needs no escaping
+    if data.isascii():
+        return bytes(data)
+    text = data.decode("utf-8", errors="surrogateescape")
+    return text.translate(UTF8_ESCAPES).encode("utf-8")
 
 
 def utf8_to_bytes(data: str):
-    output = bytearray()
-    for char in data:
-        if PUA_START <= ord(char) <= PUA_START + 0xFF:
-            output.append(ord(char) - PUA_START)
-        else:
-            output.extend(char.encode("utf-8"))
-    return bytes(output)
+    return data.translate(UTF8_UNESCAPES).encode("utf-8", errors="surrogateescape")
 
 
 class LlamaZip:
     def __init__(
-        self, model_path, n_ctx=0, n_gpu_layers=-1, use_mlock=False, verbose=False
+        self,
+        model_path,
+        n_ctx=0,
+        n_gpu_layers=-1,
+        use_mlock=False,
+        quantization=None,
+        verbose=False,
     ):
         self.verbose = verbose
         self.load_model(
@@ -245,18 +214,80 @@ class LlamaZip:
             n_ctx=n_ctx,
             n_gpu_layers=n_gpu_layers,
             use_mlock=use_mlock,
+            quantization=quantization,
         )
 
-    def load_model(self, model_path, n_ctx, n_gpu_layers, use_mlock):
+    def load_model(self, model_path, n_ctx, n_gpu_layers, use_mlock, quantization):
+        if n_gpu_layers != 0 and torch.cuda.is_available():
+            self.device = torch.device("cuda")
+            # Always bfloat16 on the GPU, so that the dtype depends only on the
+            # options and not on which GPU compressed or decompressed the data
+            dtype = torch.bfloat16
+        else:
+            self.device = torch.device("cpu")
+            dtype = torch.float32
+        if quantization is not None and self.device.type != "cuda":
+            raise ValueError(
+                "Quantization requires a CUDA GPU and a nonzero n_gpu_layers."
+            )
         loading_message = "Loading model..."
         if self.verbose:
             print(loading_message, end="", flush=True, file=sys.stderr)
         self.tokenizer = AutoTokenizer.from_pretrained(model_path)
-        self.model = AutoModelForCausalLM.from_pretrained(model_path)
+        self.bos_token_id = self.tokenizer.bos_token_id
+        self.eos_token_id = self.tokenizer.eos_token_id
+        if self.eos_token_id is None:
+            self.eos_token_id = self.tokenizer.sep_token_id
+        if self.eos_token_id is None:
+            raise ValueError("No EOS token found in tokenizer.")
+        self.adds_space_prefix = self.tokenizer_adds_space_prefix()
+        if quantization is None:
+            self.model = AutoModelForCausalLM.from_pretrained(model_path, dtype=dtype)
+            self.model.to(self.device)
+        else:
+            # Quantize the weights with bitsandbytes; the cdf is still computed
+            # in float32 from the logits
+            if quantization == "8bit":
+                quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+            elif quantization == "4bit":
+                quantization_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=dtype,
+                )
+            else:
+                raise ValueError(f"Unsupported quantization: {quantization}")
+            self.model = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                dtype=dtype,
+                quantization_config=quantization_config,
+                device_map={"": self.device},
+            )
         self.model.eval()
         # Set max context length if specified
         if n_ctx > 0:
             self.model.config.max_position_embeddings = n_ctx
+        self.max_context_length = self.model.config.max_position_embeddings
+        self.decode_step = self.model
+        # Static KV caches by batch size, or None to use dynamic caches
+        self.static_caches = None
+        if self.device.type == "cuda":
+            # Fuse the element-wise ops of the cdf computation into one kernel
+            self.compute_cdf = torch.compile(
+                self.compute_cdf, mode="reduce-overhead", fullgraph=True
+            )
+            # Replay single-token forward passes as a CUDA graph, which needs
+            # the fixed-shape KV cache of a StaticCache. A static cache
+            # preallocates (and attends over) the whole context window, so
+            # only use one when the window is small.
+            if (
+                quantization is None
+                and self.max_context_length <= MAX_STATIC_CACHE_LENGTH
+            ):
+                self.decode_step = torch.compile(
+                    self.model, mode="reduce-overhead", fullgraph=True
+                )
+                self.static_caches = {}
         if self.verbose:
             print(
                 "\r" + " " * len(loading_message) + "\r",
@@ -266,13 +297,115 @@ class LlamaZip:
             )
 
     def compute_cdf(self, logits):
-        # logits: torch.Tensor of shape (1, vocab_size)
-        logprobs = torch.nn.functional.log_softmax(logits, dim=-1)
-        probs = torch.exp(logprobs).detach().cpu().numpy()[0]
-        freqs = np.maximum(1, np.round(FREQ_SCALE_FACTOR * probs))
-        cum_freqs = np.cumsum(freqs)
+        # logits: torch.Tensor of shape (batch_size, vocab_size)
+        # The cdfs stay on the model's device; callers only pull the values
+        # they need back to the host.
+        # Scale the probabilities into frequencies in place, so the softmax
+        # output is the only vocab-sized intermediate allocated per call.
+        freqs = torch.softmax(logits, dim=-1, dtype=torch.float32)
+        freqs.mul_(FREQ_SCALE_FACTOR).round_().clamp_(min=1)
+        cum_freqs = torch.cumsum(freqs, dim=-1, dtype=torch.int64)
         return cum_freqs
 
+    def next_token_logits(self, forward, input_ids, past_key_values, cache_position):
+        # forward: the model itself, or the (possibly compiled) decode step
+        # input_ids: torch.Tensor of shape (batch_size, num_tokens), on device
+        with torch.no_grad():
+            outputs = forward(
+                input_ids=input_ids,
+                past_key_values=past_key_values,
+                cache_position=cache_position,
+                use_cache=True,
+                # Only the last position's logits are needed
+                logits_to_keep=1,
+            )
+        # logits for the next token, shape (batch_size, vocab_size)
+        return outputs.logits[:, -1, :], outputs.past_key_values
+
+    def empty_kv_cache(self, batch_size):
+        # Returns an empty KV cache for a batch, or None to let the model
+        # create a dynamic one
+        if self.static_caches is None:
+            return None
+        # Reuse one cache per batch size across calls, so the CUDA graph
+        # captured for that batch size keeps seeing the same cache tensors
+        past_key_values = self.static_caches.get(batch_size)
+        if past_key_values is None:
+            # The cache's tensors are allocated on the first forward pass, with
+            # the batch size, device, and dtype of the model's key states
+            past_key_values = StaticCache(
+                config=self.model.config, max_cache_len=self.max_context_length
+            )
+            self.static_caches[batch_size] = past_key_values
+        else:
+            past_key_values.reset()
+        return past_key_values
+
+    def token_cdfs(self, token_lists, window_overlap):
+        # Yields the cdfs of the next token of every stream, advancing all
+        # streams in lockstep so they share one batched forward pass. Before
+        # resuming, the caller must have extended each list in token_lists
+        # with its actual next token; lists that have ended are padded with EOS.
+        max_context_length = self.max_context_length
+        eos_token_id = self.eos_token_id
+        # The current context window (BOS followed by the tokens in the window),
+        # preallocated with room for one token past a full window
+        context_ids = torch.empty(
+            (len(token_lists), max_context_length + 1),
+            dtype=torch.long,
+            device=self.device,
+        )
+        context_ids[:, 0] = self.bos_token_id
+        context_length = 1
+        positions = torch.arange(max_context_length, device=self.device)
+        past_key_values = self.empty_kv_cache(len(token_lists))
+        refill = True
+        num_tokens = 0
+
+        while True:
+            if refill:
+                # (Re)fill the KV cache from the whole context window. This
+                # always runs eagerly, even when the window is a single token,
+                # so the CUDA graph is only ever captured for decode steps
+                start_idx = 0
+                forward = self.model
+                refill = False
+            else:
+                # Only feed the newest token; the rest is in the KV cache
+                start_idx = context_length - 1
+                forward = self.decode_step
+
+            logits, past_key_values = self.next_token_logits(
+                forward,
+                context_ids[:, start_idx:context_length],
+                past_key_values,
+                positions[start_idx:context_length],
+            )
+
+            # With a CUDA graph, the logits live in the graph's output buffers,
+            # which the next replay overwrites, so turn them into a cdf before
+            # handing control back. Callers must finish with each cdf before
+            # calling next() again, since that runs the next replay
+            yield self.compute_cdf(logits)
+            num_tokens += 1
+
+            newest_tokens = [
+                tokens[num_tokens - 1] if len(tokens) >= num_tokens else eos_token_id
+                for tokens in token_lists
+            ]
+            context_ids[:, context_length] = torch.tensor(newest_tokens)
+            context_length += 1
+            if context_length > max_context_length:
+                # Context window is full, so slide it, keeping the overlapping
+                # tokens (at most as many as fit alongside BOS)
+                num_kept = min(window_overlap, max_context_length - 1, num_tokens)
+                context_ids[:, 1 : 1 + num_kept] = context_ids[
+                    :, context_length - num_kept : context_length
+                ].clone()
+                context_length = 1 + num_kept
+                refill = True
+                past_key_values = self.empty_kv_cache(len(token_lists))
+
     def tokenizer_adds_space_prefix(self):
         space = " "
         double_space = "  "
@@ -283,19 +416,26 @@ class LlamaZip:
         return detokenized == double_space
 
     def compress(self, uncompressed: bytes, window_overlap=0) -> bytes:
-        uncompressed_text = bytes_to_utf8(uncompressed).decode("utf-8")
-        tokens = self.tokenizer.encode(uncompressed_text, add_special_tokens=False)
-        eos_token_id = self.tokenizer.eos_token_id
-        if eos_token_id is None:
-            eos_token_id = self.tokenizer.sep_token_id
-        if eos_token_id is None:
-            raise ValueError("No EOS token found in tokenizer.")
-        tokens.append(eos_token_id)
-
-        token_encoder = Encoder()
+        return self.compress_batch([uncompressed], window_overlap)[0]
+
+    def compress_batch(self, uncompressed_list, window_overlap=0):
+        # Streams compressed together must also be decompressed together (in
+        # the same order), since batching can change the model's numerics.
+        uncompressed_texts = [
+            bytes_to_utf8(uncompressed).decode("utf-8")
+            for uncompressed in uncompressed_list
+        ]
+        token_lists = self.tokenizer(uncompressed_texts, add_special_tokens=False)[
+            "input_ids"
+        ]
+        eos_token_id = self.eos_token_id
+        for tokens in token_lists:
+            tokens.append(eos_token_id)
+
+        token_encoders = [Encoder() for _ in token_lists]
 
         progress_bar = tqdm(
-            total=len(tokens),
+            total=sum(len(tokens) for tokens in token_lists),
             mininterval=1 / 30,
             desc="Compressing",
             unit="tok",
@@ -313,106 +453,116 @@ class LlamaZip:
         s = signal.signal(signal.SIGINT, sigint_handler)
 
         next_token_idx = 0
-        max_context_length = self.model.config.max_position_embeddings
-
-        while next_token_idx < len(tokens):
-            start_idx = max(0, next_token_idx - window_overlap)
-            context_tokens = tokens[start_idx:next_token_idx]
-            input_ids = [self.tokenizer.bos_token_id] + context_tokens
-            input_ids = torch.tensor([input_ids])
-
-            if input_ids.size(1) >= max_context_length:
-                # Truncate input_ids if necessary
-                input_ids = input_ids[:, -max_context_length:]
-
-            with torch.no_grad():
-                outputs = self.model(input_ids=input_ids)
-                logits = outputs.logits[0, -1, :]  # get logits for the next token
-
-            # Compute cdf
-            logits = logits.unsqueeze(0)
-            cdf = self.compute_cdf(logits)
-
-            # Get the next token
-            if interrupted and next_token_idx < len(tokens) - 1:
-                next_token_idx = len(tokens) - 1
-                if self.verbose:
-                    print(file=sys.stderr)
-            next_token = tokens[next_token_idx]
+        active = list(range(len(token_lists)))
+        cdfs = self.token_cdfs(token_lists, window_overlap)
+
+        while active:
+            # Each cdf must be fully consumed before the next call to
+            # next(cdfs), which may replay the CUDA graph over its buffers
+            cdf = next(cdfs)
+
+            # Skip straight to the EOS token if interrupted
+            stop = interrupted
+            if stop and self.verbose:
+                print(file=sys.stderr)
+
+            for i in active:
+                tokens = token_lists[i]
+                next_token = tokens[-1] if stop else tokens[next_token_idx]
+                token_encoders[i].encode_symbol(cdf[i], next_token)
             next_token_idx += 1
 
-            # Encode the next token
-            token_encoder.encode_symbol(cdf, next_token)
-
-            progress_bar.update()
+            progress_bar.update(len(active))
+            active = [
+                i for i in active if not stop and next_token_idx < len(token_lists[i])
+            ]
 
+        cdfs.close()
         progress_bar.close()
-        token_encoder.finish()
-        compressed = token_encoder.get_encoded()
+        compressed_list = []
+        for token_encoder in token_encoders:
+            token_encoder.finish()
+            compressed_list.append(token_encoder.get_encoded())
         signal.signal(signal.SIGINT, s)
-        return compressed
+        return compressed_list
 
     def decompress(self, compressed: bytes, window_overlap=0) -> bytes:
-        seen_tokens = []
-        decompressed = bytearray()
-        token_decoder = Decoder(compressed)
-        eos_token_id = self.tokenizer.eos_token_id
-        if eos_token_id is None:
-            eos_token_id = self.tokenizer.sep_token_id
-        if eos_token_id is None:
-            raise ValueError("No EOS token found in tokenizer.")
-
-        done = False
-        max_context_length = self.model.config.max_position_embeddings
-
-        while not done:
-            start_idx = max(0, len(seen_tokens) - window_overlap)
-            context_tokens = seen_tokens[start_idx:]
-            input_ids = [self.tokenizer.bos_token_id] + context_tokens
-            input_ids = torch.tensor([input_ids])
-
-            if input_ids.size(1) >= max_context_length:
-                # Truncate input_ids if necessary
-                input_ids = input_ids[:, -max_context_length:]
-
-            with torch.no_grad():
-                outputs = self.model(input_ids=input_ids)
-                logits = outputs.logits[0, -1, :]  # get logits for the next token
-
-            # Compute cdf
-            logits = logits.unsqueeze(0)
-            cdf = self.compute_cdf(logits)
-
-            # Decode the next token
-            next_token = token_decoder.decode_symbol(cdf)
-
-            if next_token == eos_token_id:
-                done = True
-                break
-
-            # Append the token to seen_tokens
-            seen_tokens.append(next_token)
-
-            # Decode the token to utf-8
+        return self.decompress_batch([compressed], window_overlap)[0]
+
+    def decompress_batch(self, compressed_list, window_overlap=0):
+        seen_token_lists = [[] for _ in compressed_list]
+        decompressed_list = [bytearray() for _ in compressed_list]
+        token_decoders = [Decoder(compressed) for compressed in compressed_list]
+        eos_token_id = self.eos_token_id
+        # Only stream the output as it is decoded when there is a single stream
+        stream_output = self.verbose and len(compressed_list) == 1
+
+        # Offsets into seen_tokens of the tokens already emitted as text, for
+        # each stream: [start of the last emitted chunk, end of emitted tokens]
+        offset_lists = [[0, 0] for _ in compressed_list]
+
+        def emit(i, final=False):
+            seen_tokens = seen_token_lists[i]
+            offsets = offset_lists[i]
+            prefix_offset, read_offset = offsets
+            # Decode together with the previously emitted chunk, so that the
+            # tokenizer handles the boundary as it would in the full text
+            prefix_utf8 = self.tokenizer.decode(
+                seen_tokens[prefix_offset:read_offset],
+                clean_up_tokenization_spaces=False,
+            )
             next_utf8 = self.tokenizer.decode(
-                [next_token], clean_up_tokenization_spaces=False
+                seen_tokens[prefix_offset:], clean_up_tokenization_spaces=False
             )
+            # A token can end partway through a character, which decodes to
+            # U+FFFD; hold it back until later tokens complete the character
+            if next_utf8.endswith("\ufffd") and not final:
+                return
+            next_utf8 = next_utf8[len(prefix_utf8) :]
+            offsets[:] = read_offset, len(seen_tokens)
+
             # Handle tokenizer adds space prefix
             if (
-                len(seen_tokens) == 1
+                read_offset == 0
                 and next_utf8.startswith(" ")
-                and self.tokenizer_adds_space_prefix()
+                and self.adds_space_prefix
             ):
                 next_utf8 = next_utf8[1:]
 
             # Convert utf-8 to bytes directly
             next_bytes = utf8_to_bytes(next_utf8)
-            decompressed.extend(next_bytes)
-            if self.verbose:
+            decompressed_list[i].extend(next_bytes)
+            if stream_output:
                 sys.stdout.buffer.write(next_bytes)
                 sys.stdout.buffer.flush()
 
-        return decompressed
+        active = list(range(len(compressed_list)))
+        cdfs = self.token_cdfs(seen_token_lists, window_overlap)
+
+        while active:
+            # Each cdf must be fully consumed before the next call to
+            # next(cdfs), which may replay the CUDA graph over its buffers
+            cdf = next(cdfs)
+            still_active = []
+
+            for i in active:
+                # Decode the next token
+                next_token = token_decoders[i].decode_symbol(cdf[i])
+
+                if next_token == eos_token_id:
+                    emit(i, final=True)
+                    continue
+                still_active.append(i)
+
+                # Append the token to seen_tokens
+                seen_tokens = seen_token_lists[i]
+                seen_tokens.append(next_token)
+                emit(i)
+
+            active = still_active
+
+        cdfs.close()
+        return decompressed_list
 
 
 def make_arg_parser():
@@ -451,6 +601,11 @@ def make_arg_parser():
         action="store_true",
         help="use mlock to keep model in RAM (disabled by default)",
     )
+    parser.add_argument(
+        "--quantization",
+        choices=["8bit", "4bit"],
+        help="quantize model weights with bitsandbytes (8-bit or 4-bit NF4). must use same value for compression and decompression (default: no quantization)",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -484,7 +639,7 @@ def make_arg_parser():
 
 
 def robust_b64decode(input_bytes):
-    filtered_base64 = bytes(byte for byte in input_bytes if byte in BASE64)
+    filtered_base64 = input_bytes.translate(None, delete=NON_BASE64)
     padded_base64 = filtered_base64 + b"A" * (-len(filtered_base64) % 4)
     return base64.b64decode(padded_base64)
 
@@ -498,31 +653,31 @@ def main():
     elif args.interactive and args.compressed_format != "base64":
         parser.error("interactive mode only supports base64 compressed data")
 
-    compressor = LlamaZip(
-        model_path=args.model_path,
-        use_mlock=args.use_mlock,
-        n_ctx=args.n_ctx,
-        n_gpu_layers=args.n_gpu_layers,
-        verbose=args.verbose,
-    )
+    try:
+        compressor = LlamaZip(
+            model_path=args.model_path,
+            use_mlock=args.use_mlock,
+            n_ctx=args.n_ctx,
+            n_gpu_layers=args.n_gpu_layers,
+            quantization=args.quantization,
+            verbose=args.verbose,
+        )
+    except ValueError as e:
+        parser.error(str(e))
 
     try:
         if args.overlap.endswith("%"):
             percent = float(args.overlap[:-1])
             if not (0 <= percent <= 100):
                 parser.error("window overlap must be in the range [0%, 100%]")
-            window_overlap = int(
-                percent / 100 * (compressor.model.config.max_position_embeddings - 1)
-            )
+            window_overlap = int(percent / 100 * (compressor.max_context_length - 1))
         else:
             window_overlap = int(args.overlap)
             if window_overlap < 0:
-                window_overlap += compressor.model.config.max_position_embeddings
-            if not (
-                0 <= window_overlap < compressor.model.config.max_position_embeddings
-            ):
+                window_overlap += compressor.max_context_length
+            if not (0 <= window_overlap < compressor.max_context_length):
                 parser.error(
-                    f"window overlap must be in the range [{-compressor.model.config.max_position_embeddings}, {compressor.model.config.max_position_embeddings - 1}]"
+                    f"window overlap must be in the range [{-compressor.max_context_length}, {compressor.max_context_length - 1}]"
                 )
     except ValueError:
         parser.error(